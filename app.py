@@ -1,10 +1,10 @@
 import streamlit as st
-import streamlit_authenticator as stauth
 import pandas as pd
 from sqlalchemy import create_engine, text
-from google import genai
-from PIL import Image
-import plotly.express as px
+from sqlalchemy.pool import StaticPool
+import hashlib
+import io
+import json
 import os
 from dotenv import load_dotenv
 import time
@@ -12,23 +12,44 @@ import yaml
 from yaml.loader import SafeLoader
 
 
-with open('config.yaml', encoding='utf-8') as file:
-    config = yaml.load(file, Loader=SafeLoader)
+st.set_page_config(page_title="AI 식단 관리자", layout="wide")
 
-authenticator = stauth.Authenticate(
-    config['credentials'],
-    config['cookie']['name'],
-    config['cookie']['key'],
-    config['cookie']['expiry_days']
-)
+@st.cache_resource
+def load_auth():
+    import streamlit_authenticator as stauth
+    with open('config.yaml', encoding='utf-8') as file:
+        cfg = yaml.load(file, Loader=SafeLoader)
+    return cfg, stauth.Authenticate(
+        cfg['credentials'],
+        cfg['cookie']['name'],
+        cfg['cookie']['key'],
+        cfg['cookie']['expiry_days']
+    )
 
-st.set_page_config(page_title="AI 식단 관리자", layout="wide")
+config, authenticator = load_auth()
+
+RECOGNITION_PROMPT = """
+너는 음식 인식 전문가야. 사진을 분석해서 규칙대로 답해.
+1. 음식의 표준 명칭 1개와 관련 키워드 2개를 찾아내.
+2. 반드시 '단어, 단어, 단어' 형식으로만 출력해.
+3. 설명이나 문장은 절대 포함하지 마.
+예: 돈까스, 고기튀김, 커틀릿
+"""
 
 @st.cache_resource
 def init_connection():
     load_dotenv()
-    engine = create_engine("sqlite:///diet_diary.db")
+    engine = create_engine(
+        "sqlite:///diet_diary.db",
+        poolclass=StaticPool,
+        connect_args={"check_same_thread": False}
+    )
     with engine.connect() as conn:
+        conn.execute(text("PRAGMA journal_mode=WAL"))
+        conn.execute(text("PRAGMA synchronous=NORMAL"))
+        conn.execute(text("PRAGMA temp_store=MEMORY"))
+        conn.execute(text("PRAGMA mmap_size=268435456"))
+        conn.execute(text("PRAGMA cache_size=-65536"))
         conn.execute(text("""
             CREATE TABLE IF NOT EXISTS diet_logs (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -41,16 +62,199 @@ def init_connection():
                 created_at DATETIME DEFAULT (DATETIME('now', 'localtime'))
             )
         """))
+        conn.execute(text("""
+            CREATE INDEX IF NOT EXISTS ix_diet_uid_date ON diet_logs(user_id, created_at)
+        """))
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS gemini_cache (
+                hash TEXT PRIMARY KEY,
+                response TEXT,
+                keywords TEXT,
+                result_json TEXT
+            )
+        """))
+        conn.execute(text("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS food_metadata_fts
+            USING fts5(food_name, tokenize='unicode61 remove_diacritics 2')
+        """))
+        conn.execute(text("""
+            INSERT INTO food_metadata_fts (rowid, food_name)
+            SELECT rowid, food_name FROM food_metadata
+            WHERE NOT EXISTS (SELECT 1 FROM food_metadata_fts)
+        """))
         conn.commit()
     return engine
 
 @st.cache_resource
 def get_ai_client():
+    from google import genai
     api_key = os.getenv("GEMINI_API_KEY")
     return genai.Client(api_key=api_key)
 
 engine = init_connection()
-client = get_ai_client()
+
+CACHE_SELECT = text("SELECT response, result_json FROM gemini_cache WHERE hash = :k")
+CACHE_UPSERT = text("""
+    INSERT OR REPLACE INTO gemini_cache (hash, response, keywords, result_json)
+    VALUES (:k, :r, :kw, :j)
+""")
+MATCH_QUERY = text("""
+    SELECT DISTINCT m.food_name, m.calories, m.protein, m.fat, m.carbs
+    FROM food_metadata_fts f
+    JOIN food_metadata m ON m.rowid = f.rowid
+    WHERE food_metadata_fts MATCH :q LIMIT 15
+""")
+DASHBOARD_QUERY = text("""
+    SELECT DATE(created_at) as date, SUM(calories) as daily_cal,
+           SUM(protein) as protein, SUM(fat) as fat, SUM(carbs) as carbs
+    FROM diet_logs WHERE user_id = :uid
+    GROUP BY DATE(created_at) ORDER BY date
+""")
+
+def recognize(raw_bytes: bytes, prompt: str) -> str:
+    from PIL import Image
+    client = get_ai_client()
+    img = Image.open(io.BytesIO(raw_bytes))
+    img.thumbnail((768, 768), Image.LANCZOS)
+    response = client.models.generate_content(
+        model="gemini-flash-latest",
+        contents=[prompt, img]
+    )
+    return response.text
+
+def parse_keywords(raw_text: str) -> list:
+    return [k.strip() for k in raw_text.strip().replace('\n', ',').split(',') if k.strip()]
+
+@st.cache_resource
+def get_food_lookup() -> pd.DataFrame:
+    query = text("SELECT DISTINCT food_name, calories, protein, fat, carbs FROM food_metadata")
+    return pd.read_sql(query, con=engine)
+
+def match_keywords(keywords: list) -> list:
+    clean_words = [w for w in ("".join(filter(str.isalnum, word)) for word in keywords) if w]
+    if not clean_words:
+        return []
+    match_expr = " OR ".join(f'"{w}"' for w in clean_words)
+    with engine.connect() as conn:
+        rows = conn.execute(MATCH_QUERY, {"q": match_expr}).mappings().all()
+    matches = [dict(r) for r in rows]
+    lookup = get_food_lookup()
+    mask = pd.Series(False, index=lookup.index)
+    for w in clean_words:
+        mask |= lookup['food_name'].str.contains(w, regex=False)
+    mask &= ~lookup['food_name'].isin({m['food_name'] for m in matches})
+    matches.extend(lookup[mask].head(15 - len(matches)).to_dict('records'))
+    return matches
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def analyze_image(raw_bytes: bytes, prompt: str) -> tuple:
+    key = hashlib.sha256(prompt.encode() + raw_bytes).hexdigest()
+    with engine.connect() as conn:
+        row = conn.execute(CACHE_SELECT, {"k": key}).mappings().first()
+    if row is not None and row['result_json'] is not None:
+        return parse_keywords(row['response']), json.loads(row['result_json'])
+    response_text = row['response'] if row is not None else recognize(raw_bytes, prompt)
+    keywords = parse_keywords(response_text)
+    matches = match_keywords(keywords)
+    with engine.connect() as conn:
+        conn.execute(CACHE_UPSERT, {
+            "k": key, "r": response_text,
+            "kw": ", ".join(keywords),
+            "j": json.dumps(matches, ensure_ascii=False)
+        })
+        conn.commit()
+    return keywords, matches
+
+@st.cache_data(ttl=300)
+def load_dashboard(username: str, day: str) -> tuple:
+    with engine.connect() as conn:
+        rows = conn.execute(DASHBOARD_QUERY, {"uid": username}).mappings().all()
+    totals = next(
+        (dict(r) for r in rows if r['date'] == day),
+        {"daily_cal": 0, "protein": 0, "fat": 0, "carbs": 0}
+    )
+    chart_df = pd.DataFrame([dict(r) for r in rows], columns=['date', 'daily_cal'])
+    return totals, chart_df
+
+@st.cache_data(hash_funcs={pd.DataFrame: lambda df: pd.util.hash_pandas_object(df, index=True).values.tobytes()})
+def build_line_fig(chart_df: pd.DataFrame):
+    import plotly.express as px
+    return px.line(chart_df.sort_values('date'), x='date', y='daily_cal', markers=True, render_mode='webgl')
+
+@st.cache_data
+def build_pie_fig(carbs: float, protein: float, fat: float):
+    import plotly.express as px
+    return px.pie(values=[carbs, protein, fat], names=['carbs', 'protein', 'fat'], hole=0.3)
+
+def render_chart(username: str):
+    st.subheader("📅 칼로리 추이")
+    _, chart_df = load_dashboard(username, time.strftime('%Y-%m-%d'))
+    if len(chart_df) > 500:
+        from tsdownsample import LTTBDownsampler
+        idx = LTTBDownsampler().downsample(
+            pd.to_datetime(chart_df['date']).astype('int64').to_numpy(),
+            chart_df['daily_cal'].to_numpy(dtype=float),
+            n_out=500
+        )
+        chart_df = chart_df.iloc[idx]
+    if not chart_df.empty:
+        st.plotly_chart(build_line_fig(chart_df), width='stretch')
+    else:
+        st.info("기록을 시작하면 차트가 나타납니다.")
+
+def render_pie(username: str):
+    st.subheader("🍕 오늘 영양소 비율")
+    totals, _ = load_dashboard(username, time.strftime('%Y-%m-%d'))
+    carbs, protein, fat = totals['carbs'] or 0, totals['protein'] or 0, totals['fat'] or 0
+    if carbs + protein + fat > 0:
+        st.plotly_chart(build_pie_fig(carbs, protein, fat), width='stretch')
+    else:
+        st.info("오늘의 데이터가 없습니다.")
+
+@st.fragment
+def render_upload(username: str):
+    uploaded_file = st.file_uploader("음식 사진을 올려주세요...", type=["jpg", "jpeg", "png"])
+
+    if uploaded_file:
+        from PIL import Image
+        raw_bytes = uploaded_file.getvalue()
+        img = Image.open(uploaded_file)
+        st.image(img, caption="업로드된 사진", width=300)
+
+        with st.spinner("AI 분석 중..."):
+            try:
+                keywords, matches = analyze_image(raw_bytes, RECOGNITION_PROMPT)
+            except Exception as e:
+                if "429" in str(e):
+                    st.warning("⚠️ 현재 무료 API 할당량을 모두 소모했습니다. 약 1분 후 다시 시도해주세요.")
+                else:
+                    st.error(f"❌ 분석 중 오류가 발생했습니다: {e}")
+                st.stop()
+
+        st.write(f"🔎 추출 키워드: {', '.join(keywords)}")
+
+        if matches:
+            food_options = [f"{r['food_name']} ({r['calories']}kcal)" for r in matches]
+            selected_options = st.multiselect("기록할 식품을 모두 선택하세요:", food_options)
+
+            if st.button("📌 식단 기록하기", disabled=not selected_options):
+                picked = [matches[food_options.index(opt)] for opt in selected_options]
+                log_df = pd.DataFrame([{
+                    "user_id": username, "food_name": r['food_name'],
+                    "calories": round(float(r['calories']), 1),
+                    "protein": round(float(r['protein']), 1),
+                    "fat": round(float(r['fat']), 1),
+                    "carbs": round(float(r['carbs']), 1)
+                } for r in picked])
+                log_df.to_sql('diet_logs', engine, if_exists='append', index=False,
+                              method='multi', chunksize=500)
+                load_dashboard.clear()
+                st.success("✅ 기록 완료!")
+                st.balloons()
+                time.sleep(1)
+                st.rerun(scope="app")
+        else:
+            st.error("검색 결과가 없습니다. 다른 사진을 시도해 보세요.")
 
 
 st.sidebar.title("🔐 계정 관리")
@@ -64,6 +268,7 @@ if choice == "회원가입":
             st.success('회원가입 성공! 이제 로그인 메뉴로 이동하세요.')
             with open('config.yaml', 'w', encoding='utf-8') as file:
                 yaml.dump(config, file, default_flow_style=False)
+            load_auth.clear()
     except Exception as e:
         st.error(f"회원가입 중 오류 발생: {e}")
 
@@ -79,127 +284,26 @@ elif choice == "로그인":
         authenticator.logout("로그아웃", "sidebar")
 
         st.title("🥗 AI 음식 인식 및 식단 일기")
-        
-        summary_query = text("""
-            SELECT SUM(calories) as cal, SUM(protein) as prot FROM diet_logs
-            WHERE DATE(created_at) = DATE('now', 'localtime') AND user_id = :uid
-        """)
-        summary = pd.read_sql(summary_query, con=engine, params={"uid": username})
-        
+
+        today = time.strftime('%Y-%m-%d')
+        totals, _ = load_dashboard(username, today)
+
         st.sidebar.header("📊 오늘의 요약")
-        st.sidebar.metric("총 칼로리", f"{summary['cal'][0] or 0} kcal")
-        st.sidebar.metric("총 단백질", f"{summary['prot'][0] or 0} g")
+        st.sidebar.metric("총 칼로리", f"{totals['daily_cal'] or 0} kcal")
+        st.sidebar.metric("총 단백질", f"{totals['protein'] or 0} g")
+
 
-  
         col_chart, col_pie = st.columns(2)
 
         with col_chart:
-            st.subheader("📅 최근 7일 추이")
-            chart_query = text("""
-                SELECT DATE(created_at) as date, SUM(calories) as daily_cal 
-                FROM diet_logs WHERE user_id = :uid
-                GROUP BY DATE(created_at) ORDER BY date DESC LIMIT 7
-            """)
-            chart_df = pd.read_sql(chart_query, con=engine, params={"uid": username})
-            if not chart_df.empty:
-                fig = px.line(chart_df.sort_values('date'), x='date', y='daily_cal', markers=True)
-                st.plotly_chart(fig, width='stretch')
-            else:
-                st.info("기록을 시작하면 차트가 나타납니다.")
+            render_chart(username)
 
         with col_pie:
-            st.subheader("🍕 오늘 영양소 비율")
-            ratio_query = text("""
-                SELECT SUM(carbs) as carbs, SUM(protein) as protein, SUM(fat) as fat 
-                FROM diet_logs WHERE DATE(created_at) = DATE('now', 'localtime') AND user_id = :uid
-            """)
-            ratio_df = pd.read_sql(ratio_query, con=engine, params={"uid": username})
-            if not ratio_df.empty and ratio_df.iloc[0].sum() > 0:
-                melted_df = ratio_df.melt(var_name='영양소', value_name='g')
-                pie_fig = px.pie(melted_df, values='g', names='영양소', hole=0.3)
-                st.plotly_chart(pie_fig, width='stretch')
-            else:
-                st.info("오늘의 데이터가 없습니다.")
+            render_pie(username)
 
         st.markdown("---")
 
- 
-        uploaded_file = st.file_uploader("음식 사진을 올려주세요...", type=["jpg", "jpeg", "png"])
-        
-        if uploaded_file:
-            img = Image.open(uploaded_file)
-            st.image(img, caption="업로드된 사진", width=300)
-            
-            if "result_df" not in st.session_state or st.session_state.get("last_uploaded") != uploaded_file.name:
-                with st.spinner("AI 분석 중..."):
-
-                    prompt = """
-                    너는 음식 인식 전문가야. 사진을 분석해서 규칙대로 답해.
-                    1. 음식의 표준 명칭 1개와 관련 키워드 2개를 찾아내.
-                    2. 반드시 '단어, 단어, 단어' 형식으로만 출력해.
-                    3. 설명이나 문장은 절대 포함하지 마.
-                    예: 돈까스, 고기튀김, 커틀릿
-                    """
-                    try:
-                        response = client.models.generate_content(
-                        model="gemini-flash-latest",
-                        contents=[prompt, img]
-                        )
-                    except Exception as e:
-                        if "429" in str(e):
-                            st.warning("⚠️ 현재 무료 API 할당량을 모두 소모했습니다. 약 1분 후 다시 시도해주세요.")
-                        else:
-                            st.error(f"❌ 분석 중 오류가 발생했습니다: {e}")
-                        st.stop()                
-
-                    raw_text = response.text.strip().replace('\n', ',')
-                    keywords = [k.strip() for k in raw_text.split(',') if k.strip()]
-                    
-                    st.write(f"🔎 추출 키워드: {', '.join(keywords)}")
-
-                    all_results = []
-                    with engine.connect() as conn:
-                        for word in keywords:
-
-                            clean_word = "".join(filter(str.isalnum, word))
-                            query = text("SELECT * FROM food_metadata WHERE food_name LIKE :word LIMIT 5")
-                            temp_df = pd.read_sql(query, con=conn, params={"word": f"%{clean_word}%"})
-                            if not temp_df.empty:
-                                all_results.append(temp_df)
-                    
-                    if all_results:
-                        st.session_state["result_df"] = pd.concat(all_results).drop_duplicates(subset=['food_name'])
-                    else:
-                        st.session_state["result_df"] = pd.DataFrame()
-
-                    st.session_state["last_uploaded"] = uploaded_file.name
-                    st.session_state["keywords"] = keywords
-
-            result_df = st.session_state["result_df"]
-            if not result_df.empty:
-                food_options = [f"{row['food_name']} ({row['calories']}kcal)" for _, row in result_df.iterrows()]
-                selected_option = st.radio("가장 가까운 식품을 선택하세요:", food_options)
-                
-                if st.button("📌 식단 기록하기"):
-                    best_match = result_df.iloc[food_options.index(selected_option)]
-                    with engine.connect() as conn:
-                        conn.execute(text("""
-                            INSERT INTO diet_logs (user_id, food_name, calories, protein, fat, carbs)
-                            VALUES (:uid, :name, :cal, :prot, :fat, :carb)
-                        """), {
-                            "uid": username, "name": best_match['food_name'],
-                            "cal": round(float(best_match['calories']), 1),
-                            "prot": round(float(best_match['protein']), 1),
-                            "fat": round(float(best_match['fat']), 1),
-                            "carb": round(float(best_match['carbs']), 1)
-                        })
-                        conn.commit()
-                    st.success("✅ 기록 완료!")
-                    st.balloons()
-                    time.sleep(1)
-                    st.rerun()
-            else:
-                st.error("검색 결과가 없습니다. 다른 사진을 시도해 보세요.")
+        render_upload(username)
 
     elif st.session_state["authentication_status"] is False:
         st.error('아이디 또는 비밀번호가 잘못되었습니다.')